@@ -238,7 +238,7 @@ if uploaded_files:
         with step2_container:
             # 2. Barra de Progreso
             st.markdown("### ⏳ Paso 2: Progreso del Análisis")
-            progress_bar = st.progress(0, text="Extrayendo texto de PDFs...")
+            progress_bar = st.progress(0, text="Extrayendo texto de PDFs e indexando documentos...")
             
             # Simulamos la función extract_licitacion_data pero con la actualización de la barra
             resultados_analisis = []
@@ -250,7 +250,7 @@ if uploaded_files:
                     carpeta_licitacion=licitacion_dir, 
                     progress_callback=lambda current, total, campo: progress_bar.progress(
                         (current + 1) / total, 
-                        text=f"Analizando campo: **{campo}** ({current+1}/{total})"
+                        text=f"Campo completado: **{campo}** ({current+1}/{total})"
                     )
                 )
                 resultados_analisis.append(data)
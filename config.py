@@ -18,4 +18,7 @@ if not PINECONE_API_KEY:
     raise ValueError(f"No se encontró PINECONE_API_KEY en {env_path}")
 
 if not PINECONE_INDEX_NAME:
-    raise ValueError(f"No se encontró PINECONE_INDEX_NAME en {env_path}")
\ No newline at end of file
+    raise ValueError(f"No se encontró PINECONE_INDEX_NAME en {env_path}")
+
+# Esquema declarativo de campos a extraer (reglas, recuperación, modelo, dependencias)
+CAMPOS_SCHEMA_PATH = os.getenv("CAMPOS_SCHEMA_PATH", os.path.join(os.path.dirname(__file__), "campos.json"))
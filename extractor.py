@@ -2,13 +2,15 @@ import os
 import json
 import re
 import time
+import threading
+from concurrent.futures import FIRST_COMPLETED, CancelledError, ThreadPoolExecutor, wait
 from PyPDF2 import PdfReader
 from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings 
 from langchain_core.prompts import PromptTemplate 
 from langchain_core.documents import Document 
 from langchain_text_splitters import CharacterTextSplitter
 from langchain_community.vectorstores import Chroma 
-from config import GOOGLE_API_KEY
+from config import GOOGLE_API_KEY, CAMPOS_SCHEMA_PATH
 
 # ==========================================
 # UTILIDADES
@@ -116,18 +118,201 @@ def a_texto_plano_mejorado(data: dict) -> dict:
 
     return resultado
 
+# ==========================================
+# ESQUEMA DE CAMPOS
+# ==========================================
+
+ESTRATEGIAS_VALIDAS = {"similaridad", "mmr", "carpeta"}
+CLAVES_CAMPO = {"reglas", "estrategia", "k", "modelo", "parser", "depende_de"}
+
+
+def _es_entero(valor) -> bool:
+    # bool es subclase de int, pero "k": true es casi seguro una errata
+    return isinstance(valor, int) and not isinstance(valor, bool)
+
+
+def _es_numero(valor) -> bool:
+    return isinstance(valor, (int, float)) and not isinstance(valor, bool)
+
+
+def cargar_esquema_campos(ruta: str) -> dict:
+    """Carga el esquema JSON de campos y comprueba que sea coherente."""
+    with open(ruta, encoding="utf-8") as f:
+        esquema = json.load(f)
+
+    modelos = esquema.get("modelos", {})
+    campos = esquema.get("campos", {})
+    if not campos:
+        raise ValueError(f"El esquema {ruta} no define ningún campo")
+
+    max_paralelo = esquema.get("max_paralelo", 4)
+    if not _es_entero(max_paralelo) or max_paralelo < 1:
+        raise ValueError(f"'max_paralelo' debe ser un entero >= 1 (recibido: {max_paralelo!r})")
+
+    limites_tasa = esquema.get("limites_tasa", {})
+    if not isinstance(limites_tasa, dict):
+        raise ValueError(f"'limites_tasa' debe ser un objeto (recibido: {limites_tasa!r})")
+    for nivel, limite in limites_tasa.items():
+        if nivel not in modelos and nivel != "embeddings":
+            raise ValueError(f"'limites_tasa' define el nivel '{nivel}', que no existe en 'modelos'")
+        if not isinstance(limite, dict):
+            raise ValueError(f"'limites_tasa.{nivel}' debe ser un objeto (recibido: {limite!r})")
+        max_concurrentes = limite.get("max_concurrentes", 1)
+        if not _es_entero(max_concurrentes) or max_concurrentes < 1:
+            raise ValueError(f"'max_concurrentes' de '{nivel}' debe ser un entero >= 1 (recibido: {max_concurrentes!r})")
+        pausa = limite.get("pausa", 0)
+        if not _es_numero(pausa) or pausa < 0:
+            raise ValueError(f"'pausa' de '{nivel}' debe ser un número >= 0 (recibido: {pausa!r})")
+
+    reintentos = esquema.get("reintentos", {})
+    if not isinstance(reintentos, dict):
+        raise ValueError(f"'reintentos' debe ser un objeto (recibido: {reintentos!r})")
+    max_intentos = reintentos.get("max_intentos", 4)
+    if not _es_entero(max_intentos) or max_intentos < 1:
+        raise ValueError(f"'reintentos.max_intentos' debe ser un entero >= 1 (recibido: {max_intentos!r})")
+    espera_inicial = reintentos.get("espera_inicial", 2.0)
+    if not _es_numero(espera_inicial) or espera_inicial < 0:
+        raise ValueError(f"'reintentos.espera_inicial' debe ser un número >= 0 (recibido: {espera_inicial!r})")
+
+    for nombre, campo in campos.items():
+        desconocidas = set(campo) - CLAVES_CAMPO
+        if desconocidas:
+            raise ValueError(f"Claves desconocidas en el campo '{nombre}': {', '.join(sorted(desconocidas))}")
+        estrategia = campo.get("estrategia", "similaridad")
+        if estrategia not in ESTRATEGIAS_VALIDAS:
+            raise ValueError(f"Estrategia '{estrategia}' no válida para el campo '{nombre}'")
+        modelo = campo.get("modelo", "potente")
+        if estrategia != "carpeta" and modelo not in modelos:
+            raise ValueError(f"Modelo '{modelo}' del campo '{nombre}' no definido en 'modelos'")
+        k_value = campo.get("k", 1)
+        if not _es_entero(k_value) or k_value < 0:
+            raise ValueError(f"'k' del campo '{nombre}' debe ser un entero >= 0 (recibido: {k_value!r})")
+        parser = campo.get("parser", "texto")
+        if parser not in PARSERS:
+            raise ValueError(f"Parser '{parser}' no válido para el campo '{nombre}'")
+        if not isinstance(campo.get("depende_de", []), list):
+            raise ValueError(f"'depende_de' del campo '{nombre}' debe ser una lista")
+        for dependencia in campo.get("depende_de", []):
+            if dependencia not in campos:
+                raise ValueError(f"El campo '{nombre}' depende de '{dependencia}', que no existe en el esquema")
+
+    # Falla al cargar si hay ciclos, no a mitad de una extracción
+    ordenar_por_niveles(campos)
+    return esquema
+
+
+def ordenar_por_niveles(campos: dict) -> list[list[str]]:
+    """
+    Agrupa los campos en niveles: cada nivel solo depende de niveles anteriores.
+    Se usa al cargar el esquema para detectar ciclos; la extracción no espera nivel
+    a nivel, sino que lanza cada campo en cuanto terminan sus dependencias.
+    """
+    pendientes = {nombre: set(campo.get("depende_de", [])) for nombre, campo in campos.items()}
+    niveles = []
+    while pendientes:
+        nivel = [nombre for nombre, deps in pendientes.items() if not deps]
+        if not nivel:
+            raise ValueError(f"Dependencias circulares entre los campos: {', '.join(pendientes)}")
+        niveles.append(nivel)
+        for nombre in nivel:
+            del pendientes[nombre]
+        for deps in pendientes.values():
+            deps.difference_update(nivel)
+    return niveles
+
+# ==========================================
+# PARSERS DE SALIDA
+# ==========================================
+
+def _parser_texto(raw_output: str) -> str:
+    clean_output = raw_output.strip().replace("```json", "").replace("```", "").strip()
+    return clean_output if clean_output else "-"
+
+
+def _parser_si_no(raw_output: str) -> str:
+    # Normaliza "Si"/"SI"/"sí" a "Sí" y "NO" a "No", conservando el detalle posterior
+    texto = _parser_texto(raw_output)
+    m = re.match(r"^(s[ií]|no)\b", texto, re.IGNORECASE)
+    if m:
+        respuesta = "Sí" if m.group(1).lower() != "no" else "No"
+        texto = respuesta + texto[m.end():]
+    return texto
+
+
+PARSERS = {
+    "texto": _parser_texto,
+    "si_no": _parser_si_no,
+}
+
+ESQUEMA_CAMPOS = cargar_esquema_campos(CAMPOS_SCHEMA_PATH)
+
 # ==========================================
 # CONFIGURACIÓN LLM Y EMBEDDINGS
 # ==========================================
 
-llm = ChatGoogleGenerativeAI(
-    model="gemini-2.5-flash",
-    temperature=0,
-    google_api_key=GOOGLE_API_KEY
-)
+# Un cliente por nivel de modelo: 'rapido' para respuestas cortas (Sí/No, códigos),
+# 'potente' para resúmenes y esquemas largos.
+llms = {
+    nivel: ChatGoogleGenerativeAI(
+        model=modelo,
+        temperature=0,
+        google_api_key=GOOGLE_API_KEY
+    )
+    for nivel, modelo in ESQUEMA_CAMPOS["modelos"].items()
+}
 
 embeddings = GoogleGenerativeAIEmbeddings(model="text-embedding-004", google_api_key=GOOGLE_API_KEY)
 
+# ==========================================
+# LÍMITES DE TASA Y REINTENTOS
+# ==========================================
+
+LIMITE_POR_DEFECTO = {"max_concurrentes": 1, "pausa": 1.5}
+
+# Límite compartido por todos los hilos, uno por nivel de modelo más otro para las
+# consultas de embeddings: como mucho 'max_concurrentes' llamadas a la vez y una
+# 'pausa' (segundos) antes de liberar el turno.
+LIMITES_TASA = {
+    nivel: {**LIMITE_POR_DEFECTO, **ESQUEMA_CAMPOS.get("limites_tasa", {}).get(nivel, {})}
+    for nivel in [*ESQUEMA_CAMPOS["modelos"], "embeddings"]
+}
+_semaforos = {nivel: threading.Semaphore(limite["max_concurrentes"]) for nivel, limite in LIMITES_TASA.items()}
+
+
+def _es_error_de_cuota(e: Exception) -> bool:
+    texto = f"{type(e).__name__} {e}".lower()
+    return "429" in texto or "resource_exhausted" in texto or "resourceexhausted" in texto or "quota" in texto
+
+
+def _llamar_con_limite(nivel: str, llamada, cancelado: threading.Event = None):
+    """
+    Ejecuta `llamada` respetando el límite de tasa del nivel. Si la API responde con
+    un error de cuota (429 / RESOURCE_EXHAUSTED) reintenta con espera exponencial.
+
+    Si `cancelado` se activa mientras se espera turno o entre reintentos, se lanza
+    CancelledError sin llegar a llamar a la API.
+    """
+    reintentos = ESQUEMA_CAMPOS.get("reintentos", {})
+    max_intentos = reintentos.get("max_intentos", 4)
+    espera = reintentos.get("espera_inicial", 2.0)
+
+    with _semaforos[nivel]:
+        try:
+            for intento in range(1, max_intentos + 1):
+                if cancelado is not None and cancelado.is_set():
+                    raise CancelledError(f"Extracción cancelada antes de llamar a '{nivel}'")
+                try:
+                    return llamada()
+                except Exception as e:
+                    if intento == max_intentos or not _es_error_de_cuota(e):
+                        raise
+                    time.sleep(espera)
+                    espera *= 2
+        finally:
+            # Sin pausa si se ha cancelado: nadie más va a usar el turno
+            if cancelado is None or not cancelado.is_set():
+                time.sleep(LIMITES_TASA[nivel]["pausa"])
+
 # ==========================================
 # PROMPTS Y REGLAS 
 # ==========================================
@@ -144,37 +329,79 @@ prompt_template_rag = PromptTemplate(
     )
 )
 
-# 🆕 Se añaden las reglas completas para todos los campos para que la función principal funcione.
-REGLAS_POR_CAMPO = {
-    "número de expediente": "- solo el número limpio, sin texto adicional.",
-    "cliente": "- nombre del cliente (entidad adjudicadora).",
-    "clasificación CPV": "- Lista de códigos o descripciones CPV, uno por línea, precedido por un guion (-).",
-    "valor estimado del contrato": "- Importe sin IVA, e indicar los ejercicios económicos si dura más de un año. Si no aparece, use (-).",
-    "plazo de presentación de la oferta": "- **FORMATO ESTRICTO: DD/MM/AAAA a las HH:MM (Zona Horaria).** Extrae ÚNICAMENTE la fecha y hora LÍMITE para presentar ofertas (nunca la fecha de inicio o el plazo de ejecución del contrato). Si el formato de hora no está especificado, usa HH:MM 23:59. Si la Zona Horaria no está especificada, omítela.",
-    "criterios de valoración": "- Esquema detallado con bullets, separando claramente los criterios evaluables mediante fórmulas (automáticos) de los juicios de valor (discrecionales). Añadir al final cómo obtener la máxima puntuación",
-    "resumen de trabajos o servicios a contratar": "- Descripción concisa de los trabajos o servicios, en formato de lista con bullets.",
-    "prórroga": "- Sí/No. Si es Sí, indicar duración total (Ejemplo: Sí, 2 años).",
-    "requisitos de solvencia técnica": "- Bullets con los requisitos (relación trabajos principales + ISOS necesarias). Incluir al final la referencia general a la página del documento de la licitación (Ejemplo: (Página 12-14)).",
-    "acreditación de solvencia técnica": "- Bullets con los documentos de acreditación (cómo se acreditan los requisitos de solvencia técnica). Incluir al final la referencia general a la página (Ejemplo: (Página 14)).",
-    "requisitos de solvencia económica": "- Bullets con los requisitos (volumen anual de negocio que se tiene que cumplir). Incluir al final la referencia general a la página (Ejemplo: (Página 15)).",
-    "acreditación de solvencia económica": "- Bullets con los documentos de acreditación (cómo se acreditan los requisitos de solvencia económica). Incluir al final la referencia general a la página (Ejemplo: (Página 15)).",
-    "esquema nacional de seguridad": "- Sí/No. Si es Sí, indicar el nivel (Básico/Medio/Alto).",
-    "equipo de trabajo": "- Bullets, detallando formación, años de experiencia y roles clave (añadir en este apartado los medios materiales). Incluir al final la referencia general a la página.",
-    "acreditación del equipo de trabajo": "- Bullets con los documentos de acreditación (cómo se acreditan los requisitos del equipo de trabajo). Incluir al final la referencia general a la página.",
-    "documentación por sobre (contenido de sobres)": "- Bullets resumiendo el contenido requerido para cada sobre (Técnico, Económico, etc.)(No repetir información sobre la solvencia técnica o económica). Incluir al final la referencia general a la página.",
-    "¿cuándo se acredita la solvencia técnica?":" - Indicar el momento exacto (Indicar si se acredita en la licitación o en la adjudicación). Si no se especifica, usar (-).",
-    "nombre carpeta": "- Solo el nombre de la carpeta (Ejemplo: 2024-001).",
-}
+REGLAS_POR_CAMPO = {nombre: campo.get("reglas", "") for nombre, campo in ESQUEMA_CAMPOS["campos"].items()}
 
 # 🆕 Definición de los campos (consultas) a extraer
-CAMPOS_A_EXTRAER = list(REGLAS_POR_CAMPO.keys()) # Usar las claves del diccionario de reglas.
+CAMPOS_A_EXTRAER = list(ESQUEMA_CAMPOS["campos"].keys()) # Mismo orden que en el esquema.
 
 # ==========================================
 # FUNCIÓN PRINCIPAL RAG
 # ==========================================
 
+def _recuperar_contexto(vectorstore, campo: str, config_campo: dict, contextos: dict, cancelado: threading.Event = None) -> list[str]:
+    """
+    Chunks para un campo: los de sus dependencias (ya recuperados) más los suyos propios.
+
+    El contexto se acumula de forma transitiva: `contextos[dep]` ya incluye los chunks de
+    las dependencias de `dep`, así que una cadena A -> B -> C hace que C reciba los de A,
+    los de B y los suyos. Tenerlo en cuenta al fijar `k` y el modelo de campos encadenados.
+    """
+    chunks = []
+    for dependencia in config_campo.get("depende_de", []):
+        chunks.extend(contextos.get(dependencia, []))
+
+    k_value = config_campo.get("k", 1)
+    if k_value > 0:
+        if config_campo.get("estrategia", "similaridad") == "mmr":
+            buscar = lambda: vectorstore.max_marginal_relevance_search(query=campo, k=k_value)
+        else:
+            buscar = lambda: vectorstore.similarity_search(query=campo, k=k_value)
+        retrieved_docs = _llamar_con_limite("embeddings", buscar, cancelado)
+        chunks.extend(doc.page_content for doc in retrieved_docs)
+
+    # Sin duplicados (el chunk de la dependencia suele coincidir con el propio)
+    return list(dict.fromkeys(chunks))
+
+
+def _extraer_campo(vectorstore, campo: str, config_campo: dict, contextos: dict, cancelado: threading.Event = None) -> tuple[str, list[str]]:
+    """
+    Recupera el contexto y llama al LLM del nivel configurado. Devuelve (valor, chunks usados).
+    Los fallos de recuperación o del LLM quedan como "Error: ..." en el campo, sin abortar el resto.
+    """
+    try:
+        chunks = _recuperar_contexto(vectorstore, campo, config_campo, contextos, cancelado)
+    except Exception as e:
+        return f"Error: {e}", []
+    document_content = "\n\n---\n\n".join(chunks)
+
+    if not document_content.strip():
+        return "-", chunks
+
+    try:
+        prompt = prompt_template_rag.format(
+            campo=campo,
+            reglas_campo=config_campo.get("reglas", ""),
+            document=document_content
+        )
+
+        nivel = config_campo.get("modelo", "potente")
+        response = _llamar_con_limite(nivel, lambda: llms[nivel].invoke(prompt), cancelado)
+        raw_output = response.content if hasattr(response, "content") else str(response)
+
+        parser = PARSERS[config_campo.get("parser", "texto")]
+        valor = parser(raw_output)
+    except Exception as e:
+        valor = f"Error: {e}"
+    return valor, chunks
+
+
 def extract_licitacion_data(carpeta_licitacion: str, progress_callback=None) -> dict:
-    """Extrae información de los PDFs de una licitación usando RAG."""
+    """
+    Extrae información de los PDFs de una licitación usando RAG.
+
+    `progress_callback(completados, total, campo)` se llama cada vez que un campo
+    TERMINA (en orden de finalización, no del esquema), con `completados` empezando en 0.
+    """
     print(f"📁 Procesando carpeta con RAG: {carpeta_licitacion}")
     texto = extraer_texto_pdfs(carpeta_licitacion)
 
@@ -203,65 +430,63 @@ def extract_licitacion_data(carpeta_licitacion: str, progress_callback=None) ->
                 collection_name=os.path.basename(carpeta_licitacion)
             )
 
+        campos = ESQUEMA_CAMPOS["campos"]
         resultados_rag = {}
+        contextos = {} # Chunks recuperados por campo, reutilizables por sus dependientes
 
         # Parámetros para el progreso
         total_campos = len(CAMPOS_A_EXTRAER)
+        completados = 0
+
+        # 3. y 4. Recuperación y Generación (RAG) en paralelo: cada campo se lanza en cuanto
+        # terminan sus 'depende_de', sin esperar al resto de campos independientes
+        executor = ThreadPoolExecutor(max_workers=ESQUEMA_CAMPOS.get("max_paralelo", 4))
+        cancelado = threading.Event()
+        pendientes = list(CAMPOS_A_EXTRAER) # Campos aún no lanzados, en orden del esquema
+        futuros = {}
+        try:
+            while pendientes or futuros:
+                listos = [c for c in pendientes if all(d in resultados_rag for d in campos[c].get("depende_de", []))]
+                for campo in listos:
+                    pendientes.remove(campo)
+                    # Los campos sin RAG (p. ej. 'nombre carpeta') se resuelven directamente
+                    if campos[campo].get("estrategia") == "carpeta":
+                        resultados_rag[campo] = os.path.basename(carpeta_licitacion)
+                        contextos[campo] = []
+                        if progress_callback:
+                            progress_callback(completados, total_campos, campo)
+                        completados += 1
+                        continue
+                    futuros[executor.submit(_extraer_campo, vectorstore, campo, campos[campo], contextos, cancelado)] = campo
+
+                if not futuros:
+                    if not listos:
+                        # No debería ocurrir: cargar_esquema_campos ya rechaza los ciclos
+                        raise ValueError(f"Dependencias sin resolver: {', '.join(pendientes)}")
+                    continue # Un campo 'carpeta' resuelto puede desbloquear a otros
+
+                hechos, _ = wait(futuros, return_when=FIRST_COMPLETED)
+                for futuro in hechos:
+                    campo = futuros.pop(futuro)
+                    resultados_rag[campo], contextos[campo] = futuro.result()
+                    if progress_callback:
+                        progress_callback(completados, total_campos, campo)
+                    completados += 1
+        except BaseException:
+            # Error o Stop/Rerun de Streamlit (lanzado desde el callback): no seguir gastando
+            # cuota en campos cuyo resultado se va a descartar.
+            cancelado.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown()
 
-        # 3. y 4. Recuperación y Generación (RAG Loop)
-        for i, campo in enumerate(CAMPOS_A_EXTRAER): # ❗ USAR enumerate
-            # ❗ ACTUALIZAR LA BARRA DE PROGRESO AL INICIO DEL PROCESAMIENTO DEL CAMPO
-            if progress_callback:
-                progress_callback(i, total_campos, campo)
-
-            k_value = 1
-            if campo in ["plazo de presentación de la oferta", "documentación por sobre (contenido de sobres)"]:
-                k_value = 2
-
-            # El campo 'nombre carpeta' se añade al final y no necesita RAG
-            if campo == "nombre carpeta":
-                resultados_rag[campo] = os.path.basename(carpeta_licitacion)
-                continue
-                
-            # print(f"🔍 Buscando información para: **{campo}** (k={k_value})") # Desactivar para Streamlit
-
-            # 3. Recuperación: Obtener los chunks más relevantes (top k)
-            retrieved_docs = vectorstore.similarity_search(query=campo, k=k_value)
-            document_content = "\n\n---\n\n".join([doc.page_content for doc in retrieved_docs])
-            
-            if not document_content.strip():
-                # print(f"⚠️ No se encontraron documentos relevantes para {campo}. Valor por defecto: (-)") # Desactivar para Streamlit
-                resultados_rag[campo] = "-"
-                continue
-
-            # 4. Generación: Llamar al LLM con el texto relevante.
-            try:
-                reglas = REGLAS_POR_CAMPO.get(campo, "")
-                
-                prompt = prompt_template_rag.format(
-                    campo=campo,
-                    reglas_campo=reglas,
-                    document=document_content
-                )
-                
-                response = llm.invoke(prompt)
-                raw_output = response.content if hasattr(response, "content") else str(response)
-                
-                clean_output = raw_output.strip().replace("```json", "").replace("```", "").strip() 
-                
-                resultados_rag[campo] = clean_output if clean_output else "-"
-                
-            except Exception as e:
-                # print(f"⚠️ Error al generar respuesta para {campo}: {e}") # Desactivar para Streamlit
-                resultados_rag[campo] = f"Error: {e}"
-            time.sleep(1.5) # Pausa para evitar límites de tasa
-            # print("-" * 50) # Desactivar para Streamlit
-            
         # ❗ Llamada final para asegurar el 100% en la barra (opcional si la llamada final es fuera del bucle)
         if progress_callback:
             progress_callback(total_campos - 1, total_campos, "Completado") 
 
         # 5. Limpieza Final (Usa la función original para formatear Cliente, CPV, etc.)
+        # Se respeta el orden del esquema, no el de finalización
+        resultados_rag = {campo: resultados_rag[campo] for campo in CAMPOS_A_EXTRAER}
         resultado_final = a_texto_plano_mejorado(resultados_rag)
     finally:
             # ❗ PASO CRÍTICO: Eliminar la colección de Chroma de la memoria/disco
@@ -275,4 +500,4 @@ def extract_licitacion_data(carpeta_licitacion: str, progress_callback=None) ->
                 except:
                     pass
 
-    return resultado_final
\ No newline at end of file
+    return resultado_final